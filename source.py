@@ -4,7 +4,9 @@
 # Team Number: 3
 
 import hashlib
+import json
 import os
+import sqlite3
 import struct
 import sys
 from datetime import datetime
@@ -574,6 +576,352 @@ def log(blckch_file, case_id='', item_id=-1, reverse=False, num_entries=-1):
         index += 1
 
 
+def read_blocks(blckch_file, offset=0, with_data=False):
+    """
+    Generator to stream the blocks of the blockchain file, one header at a time
+    :param blckch_file: the blockchain file for reading purpose
+    :param offset: the byte offset of the first block to read
+    :param with_data: if true the block data is read, otherwise it is skipped
+    :return: yields (offset, block_length, prev_hash, timestamp, case_id, item_id, state, data)
+    """
+    # Get the file size, to stop at the last complete block
+    blckch_file.seek(0, 2)
+    file_size = blckch_file.tell()
+
+    blckch_file.seek(offset)
+
+    while True:
+        block_header = blckch_file.read(76)
+
+        # End of file, or an incomplete trailing header
+        if len(block_header) != 76:
+            break
+
+        prev_hash, timestamp, c_id, e_id, state, data_len = struct.unpack("32s d 16s I 12s I", block_header)
+
+        # Incomplete trailing block data
+        if offset + 76 + data_len > file_size:
+            break
+
+        block_data = b''
+        if with_data:
+            block_data = blckch_file.read(data_len)
+        else:
+            blckch_file.seek(data_len, 1)
+
+        yield offset, 76 + data_len, prev_hash, timestamp, c_id, e_id, state, block_data
+        offset += 76 + data_len
+
+
+def block_hash(blckch_file, offset, length):
+    """
+    Compute the SHA-256 hash of a single block
+    :param blckch_file: the blockchain file for reading purpose
+    :param offset: the byte offset of the block
+    :param length: the length of the block, header included
+    :return: the hex digest of the block, or '' if the block is not fully present
+    """
+    blckch_file.seek(offset)
+    block = blckch_file.read(length)
+
+    if len(block) != length:
+        return ''
+
+    return hashlib.sha256(block).hexdigest()
+
+
+def state_name(state):
+    """
+    Decode a packed block state into its name
+    :param state: the 12 byte packed state
+    :return: the state name
+    """
+    for name, packed in BlockChain.states.items():
+        if packed == state:
+            return name
+
+    return state.rstrip(b'\x00').decode('utf-8', errors='replace')
+
+
+# Layout version of the report aggregates cache
+REPORT_CACHE_VERSION = 1
+
+
+def report(blckch_file, cache_path):
+    """
+    Compute custody analytics in a single streaming pass over the block headers.
+    The aggregates are cached, keyed by the offset and hash of the chain tail, so
+    that repeated runs only process the blocks appended since the last run.
+    :param blckch_file: the blockchain file for reading purpose
+    :param cache_path: the path of the aggregates cache file
+    """
+
+    def emptyCache():
+        return {
+            "version": REPORT_CACHE_VERSION,
+            "offset": 0,                # Offset right after the last processed block
+            "tail_offset": 0,           # Offset of the last processed block
+            "tail_hash": '',            # SHA-256 of the last processed block
+            "blocks": 0,
+            "cases": {},                # item id -> case id
+            "states": {},               # item id -> current state
+            "checkout_since": {},       # item id -> timestamp of the open checkout
+            "checkout_count": {},       # item id -> number of checkouts
+            "checkout_time": {},        # item id -> total seconds of closed checkouts
+            "actions_per_day": {},      # ISO date -> number of actions
+        }
+
+    def formatDuration(seconds):
+        return f"{seconds:.1f}s"
+
+    # Load the cached aggregates
+    cache = None
+    if os.path.exists(cache_path):
+        try:
+            with open(cache_path, "r") as cache_file:
+                cache = json.load(cache_file)
+        except (OSError, ValueError):
+            cache = None
+
+    def foldBlocks(cache):
+        # The cache is only valid if the chain tail it was built from is unchanged,
+        # and the cache was written with the current layout
+        if not isinstance(cache, dict) or cache.get("version") != REPORT_CACHE_VERSION or \
+                not set(cache) >= set(emptyCache()) or \
+                cache["tail_hash"] != block_hash(blckch_file, cache["tail_offset"],
+                                                 cache["offset"] - cache["tail_offset"]):
+            cache = emptyCache()
+
+        # Fold the new blocks into the aggregates
+        for offset, length, prev_hash, timestamp, c_id, e_id, state, data in read_blocks(blckch_file,
+                                                                                          cache["offset"]):
+            item = str(e_id)
+            name = state_name(state)
+
+            cache["blocks"] += 1
+            cache["tail_offset"] = offset
+            cache["offset"] = offset + length
+
+            day = datetime.fromtimestamp(timestamp).date().isoformat()
+            cache["actions_per_day"][day] = cache["actions_per_day"].get(day, 0) + 1
+
+            # The INITIAL block does not refer to an evidence item
+            if name == "INITIAL":
+                continue
+
+            cache["cases"][item] = str(uuid.UUID(c_id[::-1].hex()))
+            cache["states"][item] = name
+
+            if name == "CHECKEDOUT":
+                cache["checkout_since"][item] = timestamp
+                cache["checkout_count"][item] = cache["checkout_count"].get(item, 0) + 1
+            elif item in cache["checkout_since"]:
+                since = cache["checkout_since"].pop(item)
+                cache["checkout_time"][item] = cache["checkout_time"].get(item, 0.0) + timestamp - since
+
+        if cache["blocks"] > 0:
+            cache["tail_hash"] = block_hash(blckch_file, cache["tail_offset"], cache["offset"] - cache["tail_offset"])
+
+        return cache
+
+    # A corrupt cache is discarded, and the aggregates are rebuilt from the beginning
+    try:
+        cache = foldBlocks(cache)
+    except (KeyError, TypeError, ValueError, AttributeError):
+        cache = foldBlocks(emptyCache())
+
+    # Save the aggregates for the next run
+    try:
+        with open(cache_path, "w") as cache_file:
+            json.dump(cache, cache_file)
+    except OSError:
+        pass
+
+    # Items still checked out are counted up to now
+    now = maya.now()._epoch
+    item_time = dict(cache["checkout_time"])
+    for item, since in cache["checkout_since"].items():
+        item_time[item] = item_time.get(item, 0.0) + now - since
+
+    case_time = {}
+    case_count = {}
+    for item, count in cache["checkout_count"].items():
+        case = cache["cases"][item]
+        case_time[case] = case_time.get(case, 0.0) + item_time.get(item, 0.0)
+        case_count[case] = case_count.get(case, 0) + count
+
+    items_per_state = {}
+    for name in cache["states"].values():
+        items_per_state[name] = items_per_state.get(name, 0) + 1
+
+    # Print the report
+    print(f"Transactions in blockchain: {cache['blocks']}")
+    print()
+
+    print("Items per state:")
+    for name in sorted(items_per_state):
+        print(f"\t{name}: {items_per_state[name]}")
+    print()
+
+    checked_out = sorted(cache["checkout_since"], key=int)
+    print(f"Items checked out: {len(checked_out)}")
+    for item in checked_out:
+        print(f"\tItem: {item}")
+        print(f"\t\tCase: {cache['cases'][item]}")
+        print(f"\t\tSince: {maya.parse(datetime.fromtimestamp(cache['checkout_since'][item])).iso8601()}")
+    print()
+
+    print("Checked out duration per item:")
+    for item in sorted(cache["checkout_count"], key=int):
+        count = cache["checkout_count"][item]
+        print(f"\tItem: {item}")
+        print(f"\t\tCheckouts: {count}")
+        print(f"\t\tTotal: {formatDuration(item_time.get(item, 0.0))}")
+        print(f"\t\tAverage: {formatDuration(item_time.get(item, 0.0) / count)}")
+    print()
+
+    print("Checked out duration per case:")
+    for case in sorted(case_count):
+        print(f"\tCase: {case}")
+        print(f"\t\tCheckouts: {case_count[case]}")
+        print(f"\t\tTotal: {formatDuration(case_time[case])}")
+        print(f"\t\tAverage: {formatDuration(case_time[case] / case_count[case])}")
+    print()
+
+    print("Actions per day:")
+    for day in sorted(cache["actions_per_day"]):
+        print(f"\t{day}: {cache['actions_per_day'][day]}")
+
+
+# Layout version of the SQLite mirror
+SQLITE_MIRROR_VERSION = 2
+
+
+def sync_sqlite(blckch_file, db_path):
+    """
+    Incrementally mirror the blocks of the blockchain into an indexed SQLite database.
+    The sync resumes from the last synced offset, as long as the last synced block is unchanged.
+    :param blckch_file: the blockchain file for reading purpose
+    :param db_path: the path of the SQLite database
+    :return: 0, if the sync succeeds, 1 otherwise
+    """
+    # The position of the last mirrored block, updated as the rows are produced
+    synced = {"offset": 0, "tail_offset": 0, "blocks": 0}
+
+    def blockRows(offset):
+        for blck_offset, length, prev_hash, timestamp, c_id, e_id, state, data in read_blocks(blckch_file, offset,
+                                                                                              with_data=True):
+            synced["tail_offset"] = blck_offset
+            synced["offset"] = blck_offset + length
+            synced["blocks"] += 1
+
+            yield (blck_offset,
+                   prev_hash.rstrip(b'\x00').decode('utf-8', errors='replace'),
+                   timestamp,
+                   str(uuid.UUID(c_id[::-1].hex())),
+                   e_id,
+                   state_name(state),
+                   data.rstrip(b'\x00').decode('utf-8', errors='replace'))
+
+    conn = None
+
+    try:
+        conn = sqlite3.connect(db_path)
+
+        with conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS sync (key TEXT PRIMARY KEY, value)")
+            sync = dict(conn.execute("SELECT key, value FROM sync"))
+
+            # Rebuild the mirror if it was written with another layout
+            if sync.get("version") != SQLITE_MIRROR_VERSION:
+                conn.execute("DROP TABLE IF EXISTS blocks")
+                conn.execute("DELETE FROM sync")
+                sync = {}
+
+            conn.execute("CREATE TABLE IF NOT EXISTS blocks ("
+                         "offset INTEGER PRIMARY KEY, prev_hash TEXT, timestamp REAL, "
+                         "case_id TEXT, item_id INTEGER, state TEXT, data TEXT)")
+            conn.execute("CREATE INDEX IF NOT EXISTS blocks_case_id ON blocks (case_id, item_id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS blocks_item_id ON blocks (item_id, timestamp)")
+            conn.execute("CREATE INDEX IF NOT EXISTS blocks_state ON blocks (state)")
+            conn.execute("CREATE INDEX IF NOT EXISTS blocks_timestamp ON blocks (timestamp)")
+
+        synced["offset"] = sync.get("offset", 0)
+        synced["tail_offset"] = sync.get("tail_offset", 0)
+
+        # Resync from the beginning if the chain was rewritten since the last sync
+        if synced["offset"] > 0 and sync.get("tail_hash", '') != block_hash(
+                blckch_file, synced["tail_offset"], synced["offset"] - synced["tail_offset"]):
+            synced["offset"] = 0
+            synced["tail_offset"] = 0
+
+        with conn:
+            if synced["offset"] == 0:
+                conn.execute("DELETE FROM blocks")
+
+            # The rows are streamed into the database, one block at a time
+            conn.executemany("INSERT OR REPLACE INTO blocks VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             blockRows(synced["offset"]))
+
+            offset = synced["offset"]
+            tail_offset = synced["tail_offset"]
+            conn.executemany("INSERT OR REPLACE INTO sync VALUES (?, ?)", [
+                ("version", SQLITE_MIRROR_VERSION),
+                ("offset", offset),
+                ("tail_offset", tail_offset),
+                ("tail_hash", block_hash(blckch_file, tail_offset, offset - tail_offset) if offset > 0 else ''),
+            ])
+
+    except sqlite3.Error as error:
+        print(f"Error: {error}")
+        exit(1)
+
+    finally:
+        if conn is not None:
+            conn.close()
+
+    # Print the status message
+    print(f"Synced blocks: {synced['blocks']}")
+    print(f"\tOffset: {synced['offset']}")
+
+
+def query(db_path, sql):
+    """
+    Run a read-only query against the SQLite mirror of the blockchain
+    :param db_path: the path of the SQLite database
+    :param sql: the query to run
+    :return: 0, if the query succeeds, 1 otherwise
+    """
+    if not os.path.exists(db_path):
+        print("Error: SQLite database not found. Run sync-sqlite first.")
+        exit(1)
+
+    conn = None
+
+    try:
+        conn = sqlite3.connect(Path(db_path).resolve().as_uri() + "?mode=ro", uri=True)
+
+        # Only allow reads, so that the query cannot write files (e.g. VACUUM INTO, ATTACH)
+        conn.set_authorizer(lambda action, *args: sqlite3.SQLITE_OK if action in (
+            sqlite3.SQLITE_SELECT, sqlite3.SQLITE_READ, sqlite3.SQLITE_FUNCTION) else sqlite3.SQLITE_DENY)
+
+        cursor = conn.execute(sql)
+
+        # Print the column names, followed by the rows
+        if cursor.description is not None:
+            print("\t".join(column[0] for column in cursor.description))
+            for row in cursor:
+                print("\t".join('' if value is None else str(value) for value in row))
+
+    except sqlite3.Error as error:
+        print(f"Error: {error}")
+        exit(1)
+
+    finally:
+        if conn is not None:
+            conn.close()
+
+
 def parse(arg, blckch_file):
     """
     Function to parse the input provided in the command line, and make function calls
@@ -658,6 +1006,24 @@ def parse(arg, blckch_file):
 
         log(blckch_file, case_id, item_id, reverse, num_entries)
 
+    elif cmd == "report":
+        # The aggregates cache is kept next to the blockchain file
+        report(blckch_file, blckch_file.name + ".report")
+
+    elif cmd == "sync-sqlite":
+        # if the database path is not given
+        if len(params) != 1:
+            print("ERROR: SQLite database path is not given")
+            exit(1)
+        sync_sqlite(blckch_file, params[0])
+
+    elif cmd == "query":
+        # if either the database path or the query is missing
+        if len(params) != 2:
+            print("ERROR: Usage: query <db> <sql>")
+            exit(1)
+        query(params[0], params[1])
+
 
 if __name__ == "__main__":
 